@@ -5,36 +5,68 @@ Charge Tesla vehicle using AlphaEss Inverter.
 """
 import argparse
 import asyncio
+import importlib
+import importlib.util
 import json
 import logging
-import math
 import pprint
+import signal
 import sys
 import time
+from collections import deque
+from dataclasses import dataclass, fields
+from types import SimpleNamespace
 from typing import Optional
 
-import numpy as np
-from alphaess import alphaess  # type: ignore
 from requests import HTTPError
 from teslapy import Tesla, Vehicle, VehicleError  # type: ignore
 
-try:
-    import webview  # Optional pywebview 3.0 or higher
-except ImportError:
-    webview = None
-try:
-    from selenium import webdriver  # Optional selenium 3.13.0 or higher
-    from selenium.webdriver.support import expected_conditions as EC
-    from selenium.webdriver.support.ui import WebDriverWait
-except ImportError:
-    webdriver = None
-
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
 
+TESLA_CACHE_FILE: str = ".tesla_cache.json"
+ALPHAESS_CACHE_FILE: str = ".alphaess_cache.json"
+
+# Seconds to wait before each successive retry of a Tesla API request, by HTTP status code.
+# 429 keeps escalating across requests until one succeeds.
+RETRY_POLICY: dict = {408: [5, 10, 30], 429: [20, 60, 120, 300], "default": [30, 60, 180]}
+
+KM_FROM_MILES: float = 1.60934
+
+# Charge loop delays, in seconds
+LOOP_DELAY_ACTIVE_CHARGING: float = 60  # Normal delay for reading available power while actively charging
+LOOP_DELAY_CHARGE_CHANGE_SETTLE: float = 90  # Total for EV to change power consumption and inverter to report change
+LOOP_DELAY_EV_CHARGED: float = 2 * 3600  # Periodical check on charge level
+LOOP_DELAY_EV_STOPPED: float = 5 * 60  # Maximum delay for reading available power while stopped
+
+CHARGING_SAMPLE_COUNT: int = 3  # Available power readings averaged before changing the charge rate
+EV_ERROR_COUNT_MAX: int = 5  # Consecutive Tesla errors before the charge loop gives up
+
+# Vehicle data endpoints, fetched together in one request
+VEHICLE_DATA_ENDPOINTS: str = "charge_state;vehicle_state;drive_state"
+
+
+def __load_web_backends() -> SimpleNamespace:
+    """Import the optional web browser backends, only needed for Tesla authentication. Missing ones are None."""
+    backends = SimpleNamespace(webview=None, webdriver=None, expected_conditions=None, web_driver_wait=None)
+    try:
+        backends.webview = importlib.import_module("webview")  # Optional pywebview 3.0 or higher
+    except ImportError:
+        pass
+    try:
+        backends.webdriver = importlib.import_module("selenium.webdriver")  # Optional selenium 3.13.0 or higher
+        backends.expected_conditions = importlib.import_module("selenium.webdriver.support.expected_conditions")
+        backends.web_driver_wait = importlib.import_module("selenium.webdriver.support.ui").WebDriverWait
+    except ImportError:
+        backends.webdriver = None
+    return backends
+
 
 def __tesla_custom_auth(url):
-    """Tesla authentication callback."""
+    """Tesla authentication callback. The web browser backends are only imported when authentication is needed."""
+    backends: SimpleNamespace = __load_web_backends()
+    webview = backends.webview
+    webdriver = backends.webdriver
     # Use pywebview if no web browser specified
     if webview and not (webdriver and args.web is not None):
         result = [""]
@@ -52,7 +84,7 @@ def __tesla_custom_auth(url):
     with [webdriver.Chrome, webdriver.Edge, webdriver.Firefox, webdriver.Safari][args.web]() as browser:
         logger.debug("Selenium opened %s", browser.capabilities["browserName"])
         browser.get(url)
-        WebDriverWait(browser, 300).until(EC.url_contains("void/callback"))
+        backends.web_driver_wait(browser, 300).until(backends.expected_conditions.url_contains("void/callback"))
         return browser.current_url
 
 
@@ -65,12 +97,100 @@ def get_tesla_client(email: str) -> Tesla:
         ctx.verify_mode = ssl.CERT_NONE
         geopy.geocoders.options.default_ssl_context = ctx
     tesla_client: Tesla = Tesla(email, verify=args.verify, proxy=args.proxy, timeout=240)
-    if (webdriver and args.web is not None) or webview:
+    # Check the web browser backends are installed, without the cost of importing them
+    has_webdriver: bool = importlib.util.find_spec("selenium") is not None
+    if (has_webdriver and args.web is not None) or importlib.util.find_spec("webview") is not None:
         tesla_client.authenticator = __tesla_custom_auth
     return tesla_client
 
 
-class TeslaEv:
+def retry_delay(status_code: int, retry_number: int) -> float:
+    """Seconds to wait before the retry_number'th retry (from 1) after status_code, see RETRY_POLICY."""
+    delays: list = RETRY_POLICY.get(status_code, RETRY_POLICY["default"])
+    return delays[min(retry_number, len(delays)) - 1]
+
+
+def load_json_cache(path: str) -> dict:
+    """Load a JSON cache file. Returns an empty cache if the file is missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(path: str, cache: dict) -> None:
+    """Save a JSON cache file. A failure is only logged, as the cache is an optimisation."""
+    try:
+        with open(path, "w", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file, indent=4)
+    except OSError as err:
+        logger.warning("Failed to save cache %s: %s", path, err)
+
+
+def next_backoff(result: str, backoff_seconds: float) -> Optional[float]:
+    """Geometric back off while nothing is changing. Returns the next charge loop delay for the charging_state
+    result, or None if the result is unknown."""
+    if result == "Charged":
+        return min(backoff_seconds * 2, LOOP_DELAY_EV_CHARGED)
+    if result == "Stopped":
+        return min(backoff_seconds * 2, LOOP_DELAY_EV_STOPPED)
+    if result == "Charging":
+        return LOOP_DELAY_ACTIVE_CHARGING
+    return None
+
+
+def amps_delta_from_watts(available_watts_recent: deque, volts: float) -> int:
+    """Report the average of the recent available power readings, and the change in charge rate it allows."""
+    watts_ave: float = sum(available_watts_recent) / len(available_watts_recent)
+    print(f"   Ave. Inv available Power: {watts_ave:0.2f}")
+    amps_delta: int = int(watts_ave // volts)
+    print(f"   Amps delta: {amps_delta}")
+    return amps_delta
+
+
+def count_tesla_error(ex: Exception, during: str, error_count: int) -> int:
+    """Report a Tesla API error. Returns the incremented consecutive error count."""
+    logger.error("Tesla error caught during %s", during)
+    logger.critical(ex)
+    error_count += 1
+    logger.error("ev_error_count_consecutive: %d", error_count)
+    return error_count
+
+
+@dataclass(slots=True)
+class ChargeState:  # pylint: disable=too-many-instance-attributes
+    """The Tesla Vehicle's 'charge_state' data values used for charging."""
+
+    charging_state: str
+    charger_actual_current: int
+    charge_current_request_max: int
+    not_enough_power_to_heat: Optional[bool]
+    charge_port_latch: str
+    charge_port_door_open: bool
+    battery_range: float
+    battery_level: float
+    charge_limit_soc: int
+    charge_miles_added_rated: float
+    charge_energy_added: float
+    time_to_full_charge: float
+
+    @classmethod
+    def from_dict(cls, charge_state: dict) -> "ChargeState":
+        """Pick the fields out of the 'charge_state' dict returned by the Tesla API."""
+        return cls(**{field.name: charge_state[field.name] for field in fields(cls)})
+
+
+@dataclass
+class VehicleSnapshot:
+    """The vehicle data from one fetch, shared by its users within the same charge loop tick."""
+
+    vehicle_id: int
+    tick: int
+    vehicle_data: dict
+
+
+class TeslaEv:  # pylint: disable=too-many-instance-attributes
     """Tesla EV."""
 
     def __init__(self, config: dict) -> None:
@@ -78,63 +198,105 @@ class TeslaEv:
         self.config = config
         self.charge_amps_min: int = 1  # Tesla charging is inefficient at low amps
         self.communication_timeout: int = 240
+        self.api_call_times: deque = deque()  # Recent Tesla API request times, for the hourly rate
+        self.awake_timestamp: float = 0.0  # When the vehicle was last known to be online
+        self.awake_max_age: float = 5 * 60  # Assume the vehicle is still online for this long
+        self.consecutive_429: int = 0  # Too Many Requests responses, escalating across calls
+        self.snapshot: Optional[VehicleSnapshot] = None
+        self.charging_state: Optional[str] = None  # Last known charging_state e.g. Charging
 
         # Tesla
         self.tesla_client: Tesla = get_tesla_client(self.config["auth_email"])
         self.tesla_client.timeout = self.communication_timeout
-        self.ev: Vehicle = self.tesla_client.vehicle_list()[self.config["vehicle_idx"]]
-
-    def __del__(self):
-        """Destructor."""
-        # Safety measure to handle unexpected application termination
-        if self.ev is not None:
-            self.ev.command("STOP_CHARGE")
-            self.ev = None
-
-        # Tesla car UI will crash if we called charge_data() and exit before
-        # calling close.
-        if self.tesla_client is not None:
-            self.tesla_client.close()
-            self.tesla_client = None
+        self.ev: Vehicle = self.load_vehicle()
+
+    async def aclose(self) -> None:
+        """Stop charging and close the Tesla connection."""
+        try:
+            # Safety measure to handle unexpected application termination
+            if self.ev is not None and self.charging_state == "Charging":
+                self.record_api_call("STOP_CHARGE")
+                await asyncio.to_thread(self.ev.command, "STOP_CHARGE")
+                self.charging_state = "Stopped"
+        except (VehicleError, HTTPError) as err:
+            logger.error("Failed to stop charging: %s", err)
+        finally:
+            # Tesla car UI will crash if we called charge_data() and exit before
+            # calling close.
+            if self.tesla_client is not None:
+                await asyncio.to_thread(self.tesla_client.close)
+                self.tesla_client = None
+
+    def load_vehicle(self, refresh: bool = False) -> Vehicle:
+        """Get the configured Tesla Vehicle. The vehicle's ids are cached on disk, so vehicle_list() is only called
+        the first time, or when refresh is set e.g. the cached vehicle is no longer found."""
+        email: str = self.config["auth_email"]
+        vehicle_idx: str = str(self.config["vehicle_idx"])
+        cache: dict = load_json_cache(TESLA_CACHE_FILE)
+        cached: Optional[dict] = cache.get(email, {}).get(vehicle_idx)
+        if cached is not None and not refresh:
+            # The online state isn't cached. Seed it, as a missing key makes teslapy fetch all the vehicle data,
+            # which fails while asleep. The stale timestamp makes sync_wake_up() refresh it from the vehicle summary.
+            ev: Vehicle = Vehicle(dict(cached, state="unknown"), self.tesla_client)
+            ev.timestamp = 0.0
+            return ev
+
+        ev = self.tesla_client.vehicle_list()[self.config["vehicle_idx"]]
+        cache.setdefault(email, {})[vehicle_idx] = {
+            key: ev[key] for key in ("id", "id_s", "vehicle_id", "vin", "display_name")
+        }
+        save_json_cache(TESLA_CACHE_FILE, cache)
+        return ev
+
+    def record_api_call(self, name: str) -> None:
+        """Track the Tesla API request rate. Tesla charges for, and throttles, requests per account."""
+        now: float = time.time()
+        self.api_call_times.append(now)
+        while self.api_call_times[0] < now - 3600:
+            self.api_call_times.popleft()
+        logger.debug("Tesla API %s, %d requests in the last hour", name, len(self.api_call_times))
 
     @classmethod
-    def is_able_to_charge(cls, charge_state: dict) -> Optional[str]:
+    def is_able_to_charge(cls, charge_state: ChargeState) -> Optional[str]:
         """Optionally returns the reason the ev can't be charged.
         Eg. charge_port_latch not Engaged."""
 
-        if charge_state["not_enough_power_to_heat"] is not None:
-            return f"not_enough_power_to_heat : {charge_state['not_enough_power_to_heat']}"
-        if charge_state["charge_port_latch"] != "Engaged":
-            return f"charge_port_latch : {charge_state['charge_port_latch']}"
-        if not charge_state["charge_port_door_open"]:
-            return f"charge_port_door_open : {charge_state['charge_port_door_open']}"
+        if charge_state.not_enough_power_to_heat is not None:
+            return f"not_enough_power_to_heat : {charge_state.not_enough_power_to_heat}"
+        if charge_state.charge_port_latch != "Engaged":
+            return f"charge_port_latch : {charge_state.charge_port_latch}"
+        if not charge_state.charge_port_door_open:
+            return f"charge_port_door_open : {charge_state.charge_port_door_open}"
         return None
 
     @classmethod
-    def report_charge_state_summary(cls, charge_state: dict) -> None:
+    def report_charge_state_summary(cls, charge_state: ChargeState) -> None:
         """Report to the user a summary of the charge state."""
-        print("\nTesla:")
-        km_from_miles: float = 1.60934
-        km_range: float = charge_state["battery_range"] * km_from_miles
-        soc_limit: float = charge_state["charge_limit_soc"]
-        print(f"   Battery: {km_range:0.1f} km, {charge_state['battery_level']:0.1f}% (limit {soc_limit:d}%)")
-        km_added: float = charge_state["charge_miles_added_rated"] * km_from_miles
-        print(f"   Charge added: {km_added:0.1f} km, {charge_state['charge_energy_added']:0.2f} kw")
-        time_to_full_charge: float = charge_state["time_to_full_charge"]
+        km_range: float = charge_state.battery_range * KM_FROM_MILES
+        soc_limit: int = charge_state.charge_limit_soc
+        km_added: float = charge_state.charge_miles_added_rated * KM_FROM_MILES
+        lines: list = [
+            "\nTesla:",
+            f"   Battery: {km_range:0.1f} km, {charge_state.battery_level:0.1f}% (limit {soc_limit:d}%)",
+            f"   Charge added: {km_added:0.1f} km, {charge_state.charge_energy_added:0.2f} kw",
+        ]
+        time_to_full_charge: float = charge_state.time_to_full_charge
         if time_to_full_charge != 0:
-            print(f"   Time to full charge: {time_to_full_charge:0.1f} hrs")
+            lines.append(f"   Time to full charge: {time_to_full_charge:0.1f} hrs")
+        print("\n".join(lines))
 
-    def calculate_charger_amps_request(self, amps_delta: int, charge_state: dict) -> int:
+    def calculate_charger_amps_request(self, amps_delta: int, charge_state: ChargeState) -> int:
         """Calculate amps for charging rate."""
-        amps_request: int = charge_state["charger_actual_current"] + amps_delta
+        amps_request: int = charge_state.charger_actual_current + amps_delta
+        charge_amps_min: int = self.charge_amps_min
+        charge_current_request_max: int = charge_state.charge_current_request_max
 
         # Validate charge rate
         if amps_request < 0:
             amps_request = 0
         else:
-            if amps_request < self.charge_amps_min:
+            if amps_request < charge_amps_min:
                 amps_request = 0
-        charge_current_request_max: int = charge_state["charge_current_request_max"]
         if amps_request > charge_current_request_max:
             logger.error(
                 "charger_amps_request %s tried to exceed charge_current_request_max %s",
@@ -144,69 +306,137 @@ class TeslaEv:
             amps_request = charge_current_request_max
         return amps_request
 
-    def get_charge_state(self, attempts_max: int = 3) -> dict:
-        """Get the Tesla Vehicle's 'charge_state' data values. Has a re-try loop and basic error handling."""
+    async def get_vehicle_data(self, attempts_max: int = 4) -> dict:
+        """Get the Tesla Vehicle's data values for VEHICLE_DATA_ENDPOINTS, keyed by endpoint e.g. 'charge_state'.
+        Has a re-try loop and basic error handling."""
         attempts_count: int = 0
         last_exception: HTTPError = None
+        woken: bool = False
+        if self.consecutive_429 > 0:
+            # Still throttled after an earlier call, so keep to its back off before asking again
+            await asyncio.sleep(retry_delay(429, self.consecutive_429))
         while attempts_count < attempts_max:
             try:
                 attempts_count += 1
-                vehicle_data: dict = self.ev.get_vehicle_data(endpoints="charge_state")
-                return vehicle_data["charge_state"]
+                self.record_api_call("VEHICLE_DATA")
+                vehicle_data: dict = await asyncio.to_thread(self.ev.get_vehicle_data, endpoints=VEHICLE_DATA_ENDPOINTS)
+                self.awake_timestamp = time.time()
+                self.consecutive_429 = 0
+                return dict(vehicle_data)  # The Vehicle is updated in place by later fetches
             except HTTPError as err:
                 last_exception = err
                 logger.warning(repr(err))
                 status_code: int = err.response.status_code
                 logger.debug("status_code: %d", status_code)
+                retry_number: int = attempts_count
+                if status_code == 404:  # cached vehicle is unknown to Tesla
+                    logger.info("Refreshing Tesla Vehicle list")
+                    self.ev = await asyncio.to_thread(self.load_vehicle, True)
+                    continue
                 if status_code == 408:  # vehicle is offline or asleep
-                    logger.info("Attempting to wake Tesla Vehicle")
-                    self.ev.sync_wake_up(timeout=self.communication_timeout)
-                    time.sleep(5.0)
+                    self.awake_timestamp = 0.0
+                    if not woken:
+                        logger.info("Attempting to wake Tesla Vehicle")
+                        self.record_api_call("WAKE_UP")
+                        await asyncio.to_thread(self.ev.sync_wake_up, timeout=self.communication_timeout)
+                        self.awake_timestamp = time.time()
+                        woken = True
                 elif status_code == 429:  # Too Many Requests
                     logger.critical(err)
-                    time.sleep(20.0)
+                    self.consecutive_429 += 1
+                    retry_number = self.consecutive_429
                 else:
                     logger.error("Unknown HTTPError exception. Update this code to handle it")
                     logger.critical(err)
-                    time.sleep(30.0)
+                if attempts_count < attempts_max:
+                    delay: float = retry_delay(status_code, retry_number)
+                    logger.debug("retrying in %d seconds", delay)
+                    await asyncio.sleep(delay)
         raise last_exception
 
-    def report_and_change_charge_rate(self, amps_delta: int) -> str:
-        """1) Report to the user a summary of the charge state.
-        2) Change amps rate if not Charged.
-        3_ Return the charging_state e.g Charged, Charging, or Stopped."""
-        charge_state: dict = self.get_charge_state()
-        logger.debug("charge_state: %s", pp.pformat(charge_state))
+    async def is_online(self) -> bool:
+        """Whether the vehicle is online. Reads the vehicle summary, which doesn't wake the vehicle."""
+        self.record_api_call("VEHICLE_SUMMARY")
+        online: bool = await asyncio.to_thread(self.ev.available, 0)
+        if online:
+            self.awake_timestamp = time.time()
+        return online
+
+    async def has_resumed_charging(self, tick: int) -> bool:
+        """Whether a Charged vehicle can take charge again e.g. its charge limit was raised. Only an online vehicle is
+        read, so an asleep one is left asleep."""
+        if not await self.is_online():
+            return False
+        vehicle_data: dict = await self.fetch_vehicle_data(tick)
+        # Not e.g. Disconnected
+        return vehicle_data["charge_state"]["charging_state"] in ("Charging", "Stopped")
+
+    async def fetch_vehicle_data(self, tick: int) -> dict:
+        """Get the vehicle data, fetching it at most once per charge loop tick."""
+        snapshot: Optional[VehicleSnapshot] = self.snapshot
+        if snapshot is None or snapshot.vehicle_id != self.ev["id"] or snapshot.tick != tick:
+            snapshot = VehicleSnapshot(self.ev["id"], tick, await self.get_vehicle_data())
+            self.snapshot = snapshot
+            self.charging_state = snapshot.vehicle_data["charge_state"]["charging_state"]
+        return snapshot.vehicle_data
+
+    async def fetch_charge_state(self, tick: int) -> ChargeState:
+        """Get the charge state and report to the user a summary of it."""
+        raw_charge_state: dict = (await self.fetch_vehicle_data(tick))["charge_state"]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("charge_state: %s", pp.pformat(raw_charge_state))
+        charge_state: ChargeState = ChargeState.from_dict(raw_charge_state)
         self.report_charge_state_summary(charge_state)
-
+        return charge_state
+
+    async def change_charge_rate(self, amps_delta: int, tick: int, charge_state: Optional[ChargeState] = None) -> str:
+        """Apply amps_delta to the charge state, fetching it first if not given. Returns the charging_state."""
+        if charge_state is None:
+            charge_state = await self.fetch_charge_state(tick)
+        return await asyncio.to_thread(self.apply_amps, amps_delta, charge_state)
+
+    def apply_amps(self, amps_delta: int, charge_state: ChargeState) -> str:
+        """1) Change amps rate if not Charged.
+        2) Return the charging_state e.g Charged, Charging, or Stopped.
+        Makes blocking Tesla API calls, so run it in a worker thread."""
         reason = self.is_able_to_charge(charge_state)
         if reason is not None:
             return reason
 
-        if charge_state["charging_state"] == "Charged":
-            return charge_state["charging_state"]
+        if charge_state.charging_state == "Charged":
+            return charge_state.charging_state
 
         charger_amps_request: int = self.calculate_charger_amps_request(amps_delta, charge_state)
 
         # Set charge rate
         print("")
-        charger_actual_amps: int = charge_state["charger_actual_current"]
+        charger_actual_amps: int = charge_state.charger_actual_current
         if charger_actual_amps == charger_amps_request:
-            print(f"Charging state remains {charge_state['charging_state']}, {charger_actual_amps} amps.")
-            return charge_state["charging_state"]  # 'Stopped', 'Charging', Charged
+            print(f"Charging state remains {charge_state.charging_state}, {charger_actual_amps} amps.")
+            return charge_state.charging_state  # 'Stopped', 'Charging', Charged
 
         print(f"Requesting charge rate {charger_amps_request} amps, was {charger_actual_amps}.")
-        self.ev.sync_wake_up(timeout=self.communication_timeout)
-        self.ev.command("CHARGING_AMPS", charging_amps=charger_amps_request)
+        # Only issue the commands that change something
+        if time.time() - self.awake_timestamp > self.awake_max_age:
+            self.record_api_call("WAKE_UP")
+            self.ev.sync_wake_up(timeout=self.communication_timeout)
+            self.awake_timestamp = time.time()
         if charger_amps_request == 0:
-            self.ev.command("STOP_CHARGE")
+            if charge_state.charging_state != "Stopped":
+                self.record_api_call("STOP_CHARGE")
+                self.ev.command("STOP_CHARGE")
+                self.charging_state = "Stopped"
             return "Stopped"
-        if charger_actual_amps == 0:
+        self.record_api_call("CHARGING_AMPS")
+        self.ev.command("CHARGING_AMPS", charging_amps=charger_amps_request)
+        if charger_actual_amps == 0 and charge_state.charging_state != "Charging":
+            self.record_api_call("START_CHARGE")
             self.ev.command("START_CHARGE")
+            self.charging_state = "Charging"
         return "Charging"
 
 
-class AlphaEssInverter:
+class AlphaEssInverter:  # pylint: disable=too-many-instance-attributes
     """AlphaEss Inverter."""
 
     def __init__(self, config: dict) -> None:
@@ -214,29 +444,59 @@ class AlphaEssInverter:
 
         self.inverter_volts: float = 240.0
         self.inverter_power_max: float
+        self.inverter_cache_ttl: float = 7 * 24 * 3600  # The inverter rating rarely changes
+
+        self.communication_timeout: int = 30
+
+        import aiohttp  # pylint: disable=import-outside-toplevel
+        from alphaess import alphaess  # type: ignore # pylint: disable=import-outside-toplevel
 
+        # One session for all AlphaEss requests, so connections are reused between polls
+        self.session: aiohttp.ClientSession = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.communication_timeout)
+        )
         self.inverter_serial = self.config["serial"]
-        self.alphaess_client: alphaess = alphaess.alphaess(self.config["app_id"], self.config["app_secret"])
+        self.alphaess_client: alphaess = alphaess.alphaess(
+            self.config["app_id"], self.config["app_secret"], session=self.session
+        )
+
+    async def aclose(self) -> None:
+        """Close the AlphaEss connection."""
+        await self.alphaess_client.close()
+        await self.session.close()
 
     async def private_async_init(self) -> None:
         """Handle any async initialisation"""
 
+        # The inverter rating is cached on disk, so restarts can skip the AlphaEss requests
+        cache: dict = load_json_cache(ALPHAESS_CACHE_FILE)
+        cached: dict = cache.get(self.inverter_serial, {})
+        timestamp: Optional[float] = cached.get("timestamp")
+        if timestamp is not None and time.time() - timestamp < self.inverter_cache_ttl:
+            self.inverter_power_max = cached["inverter_power_max"]
+            logger.debug("inverter_power_max: %0.2f (cached)", self.inverter_power_max)
+            return
+
         # AlphaEss
         authenticated = await self.alphaess_client.authenticate()
         if not authenticated:
             logger.fatal("AlphaEss authentication failure, quitting")
-        time.sleep(1.0)  # AlphaEss wants a delay between requests
+        await asyncio.sleep(1.0)  # AlphaEss wants a delay between requests
 
         # Get the inverter rating
         units = await self.alphaess_client.getESSList()
-        logger.debug("units: %s", pp.pformat(units))
-        for unit in units:
-            if unit.get("sysSn") == self.inverter_serial and unit.get("poinv") is not None:
-                self.inverter_power_max = unit["poinv"] * 1000.0
-                break
-        else:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("units: %s", pp.pformat(units))
+        units_by_sn: dict = {unit.get("sysSn"): unit for unit in units}
+        unit: Optional[dict] = units_by_sn.get(self.inverter_serial)
+        if unit is None:
             raise ValueError(f"Failed to find AlphaEss unit with SSN {self.inverter_serial}")
+        if unit.get("poinv") is None:
+            raise ValueError(f"AlphaEss unit with SSN {self.inverter_serial} has no power rating")
+        self.inverter_power_max = unit["poinv"] * 1000.0
         logger.debug("inverter_power_max: %0.2f", self.inverter_power_max)
+        cache[self.inverter_serial] = {"inverter_power_max": self.inverter_power_max, "timestamp": time.time()}
+        save_json_cache(ALPHAESS_CACHE_FILE, cache)
 
     def volts(self) -> float:
         """the voltage the inverter outputs"""
@@ -250,7 +510,8 @@ class AlphaEssInverter:
           feed-in. Defaults to 0, which means only consider the fead-in"""
 
         last_power: dict = await self.alphaess_client.getLastPowerData(self.inverter_serial)
-        logger.debug("last_power: %s", pp.pformat(last_power))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("last_power: %s", pp.pformat(last_power))
 
         battery_charging: float = -1 * last_power["pbat"]
         feed_in: float = -1 * last_power["pgridDetail"]["pmeterL1"]
@@ -274,9 +535,10 @@ class AlphaEssInverter:
     @classmethod
     def report_home_power(cls, home_battery_soc: float, inverter_available_watts: float) -> None:
         """Report major properties of the inverter."""
-        print("Inverter:")
-        print(f"   Battery SoC: {home_battery_soc:0.1f}%")
-        print(f"   Latest available power: {inverter_available_watts:0.1f} watts")
+        print(
+            f"Inverter:\n   Battery SoC: {home_battery_soc:0.1f}%\n"
+            f"   Latest available power: {inverter_available_watts:0.1f} watts"
+        )
 
 
 async def charge_loop(ev: TeslaEv, inverter: AlphaEssInverter) -> None:
@@ -288,61 +550,66 @@ async def charge_loop(ev: TeslaEv, inverter: AlphaEssInverter) -> None:
     provide as AC.
     """
 
-    # Constants
-    loop_delay_active_charging: float = 60
-    # Normal delay for reading available power while actively charging
-    loop_delay_charge_change_settle: float = 90
-    # Total for EV to change power consumption and inverter to report change
-    loop_delay_ev_charged: float = 2 * 3600
-    # Periodical check on charge level
-
-    charging_sample_count: int = 3
-    ev_error_count_max: int = 5
-
     print("Charge loop starting")
-    available_watts_recent = np.array([], dtype=float)
+    available_watts_recent: deque = deque(maxlen=CHARGING_SAMPLE_COUNT)
     ev_error_count_consecutive: int = 0
     result: str = "unset"
-    while ev_error_count_consecutive < ev_error_count_max:
-        loop_sleep_time: float = loop_delay_active_charging
-        avail: float = await inverter.available_watts()
-        available_watts_recent = np.insert(available_watts_recent, 0, [avail])
-        available_watts_recent = available_watts_recent[:charging_sample_count]
+    backoff_seconds: float = LOOP_DELAY_ACTIVE_CHARGING
+    tick: int = 0
+    while ev_error_count_consecutive < EV_ERROR_COUNT_MAX:
+        tick += 1
+        if result == "Charged":
+            # Leave a Charged vehicle asleep and skip the inverter
+            try:
+                if await ev.has_resumed_charging(tick):
+                    result = "unset"  # Evaluate from scratch. The vehicle data fetched this tick is reused.
+                ev_error_count_consecutive = 0
+            except (VehicleError, HTTPError) as ex1:
+                ev_error_count_consecutive = count_tesla_error(ex1, "Charged check", ev_error_count_consecutive)
+            if result == "Charged":
+                backoff_seconds = min(backoff_seconds * 2, LOOP_DELAY_EV_CHARGED)
+                logger.debug("result: %s, sleeping for %02d", result, backoff_seconds)
+                await asyncio.sleep(backoff_seconds)
+                continue
+
+        loop_sleep_time: float = LOOP_DELAY_ACTIVE_CHARGING
+        charge_state: Optional[ChargeState] = None
+        if result == "unset":
+            # The first pass always reads the vehicle, so read it concurrently with the inverter.
+            # Otherwise the vehicle is only read once amps_delta shows the charge rate must change.
+            try:
+                avail, charge_state = await asyncio.gather(inverter.available_watts(), ev.fetch_charge_state(tick))
+            except (VehicleError, HTTPError) as ex1:
+                ev_error_count_consecutive = count_tesla_error(ex1, "fetch_charge_state", ev_error_count_consecutive)
+                await asyncio.sleep(loop_sleep_time)
+                continue
+        else:
+            avail = await inverter.available_watts()
+        available_watts_recent.appendleft(avail)
         logger.debug("available_watts_recent: %s", available_watts_recent)
 
-        if result == "unset" or np.size(available_watts_recent) == charging_sample_count:
-            watts_ave = np.average(available_watts_recent)
-            print(f"   Ave. Inv available Power: {watts_ave:0.2f}")
-            amps_delta: int = math.floor(watts_ave / inverter.volts())
-            print(f"   Amps delta: {amps_delta}")
+        if result == "unset" or len(available_watts_recent) == CHARGING_SAMPLE_COUNT:
+            amps_delta: int = amps_delta_from_watts(available_watts_recent, inverter.volts())
             if (
                 result == "unset"
                 or (result == "Charging" and amps_delta != 0)
                 or (result == "Stopped" and amps_delta > 0)
             ):
                 try:
-                    result = ev.report_and_change_charge_rate(amps_delta)
-                    loop_sleep_time = loop_delay_charge_change_settle
-                    available_watts_recent = np.array([], dtype=float)
+                    result = await ev.change_charge_rate(amps_delta, tick, charge_state)
+                    loop_sleep_time = LOOP_DELAY_CHARGE_CHANGE_SETTLE
+                    available_watts_recent.clear()
                     ev_error_count_consecutive = 0
-                except VehicleError as ex1:
-                    logger.error("VehicleError caught during report_and_change_charge_rate")
-                    logger.critical(ex1)
-                    ev_error_count_consecutive += 1
-                    logger.error("ev_error_count_consecutive: %d", ev_error_count_consecutive)
-            if result == "Charged":
-                loop_sleep_time = loop_delay_ev_charged
-            elif result == "Stopped":
-                # TODO some kind of geometric back off
-                loop_sleep_time = loop_delay_active_charging
-            elif result == "Charging":
-                loop_sleep_time = loop_delay_active_charging
-            else:
+                except (VehicleError, HTTPError) as ex1:
+                    ev_error_count_consecutive = count_tesla_error(ex1, "apply_amps", ev_error_count_consecutive)
+            backoff: Optional[float] = next_backoff(result, backoff_seconds)
+            if backoff is None:
                 logger.error("Quitting. Unknown result: %s", result)
                 break
+            backoff_seconds = loop_sleep_time = backoff
 
         logger.debug("result: %s, sleeping for %02d", result, loop_sleep_time)
-        time.sleep(loop_sleep_time)
+        await asyncio.sleep(loop_sleep_time)
 
 
 async def main() -> None:
@@ -360,10 +627,31 @@ async def main() -> None:
         data = myfile.read()
         config = json.loads(data)
 
-    ev: TeslaEv = TeslaEv(config["tesla"])
-    inverter: AlphaEssInverter = AlphaEssInverter(config["alphaess"])
-    await inverter.private_async_init()
-    await charge_loop(ev, inverter)
+    # Cancel on SIGINT/SIGTERM so the cleanup below still runs
+    loop = asyncio.get_running_loop()
+    main_task: Optional[asyncio.Task] = asyncio.current_task()
+    if main_task is not None:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, main_task.cancel)
+
+    ev: Optional[TeslaEv] = None
+    inverter: Optional[AlphaEssInverter] = None
+    try:
+        try:
+            ev = TeslaEv(config["tesla"])
+            inverter = AlphaEssInverter(config["alphaess"])
+            await inverter.private_async_init()
+            await charge_loop(ev, inverter)
+        finally:
+            # Clean up whatever was created
+            try:
+                if ev is not None:
+                    await ev.aclose()
+            finally:
+                if inverter is not None:
+                    await inverter.aclose()
+    except asyncio.CancelledError:
+        logger.info("Stopped by signal")
     print("main ending")
 
 
@@ -373,9 +661,11 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--debug", action="store_true", help="set main module logging level to debug")
     parser.add_argument("--verify", action="store_false", help="disable verify SSL certificate")
 
-    if webdriver:
+    # Check the optional web browser backends are installed, without the cost of importing them
+    if importlib.util.find_spec("selenium") is not None:
+        has_webview: bool = importlib.util.find_spec("webview") is not None
         for c, s in enumerate(("chrome", "edge", "firefox", "safari")):
-            d, h = (0, " (default)") if not webview and c == 0 else (None, "")
+            d, h = (0, " (default)") if not has_webview and c == 0 else (None, "")
             parser.add_argument(
                 "--" + s, action="store_const", dest="web", help=f"use {s.title() + h} browser", const=c, default=d
             )